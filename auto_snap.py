@@ -11,17 +11,42 @@ import time
 import logging
 from datetime import datetime
 from pathlib import Path
-from typing import Tuple, Optional, List
-import schedule
+from typing import Tuple, Optional, List, Dict
+import tempfile
+import threading
+from collections import OrderedDict
+import numpy as np
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from PIL import Image
 from io import BytesIO
 import sys
 import re
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from urllib.parse import urlparse, parse_qs
 
 # Constants
 TILE_SIZE_PX = 1000
+DEFAULT_MAX_WORKERS = 8
+TILE_CACHE_DIR = '.tilecache'
+TILE_CACHE_MAX_BYTES = 256 * 1024 * 1024
+# Tiles compressing to at most this many bytes (blank or uniform tiles) are
+# decoded once per screenshot and reused; larger tiles are rarely identical
+SHARED_TILE_MAX_BYTES = 4096
+TILE_MEMORY_CACHE_SIZE = 500
+DEFAULT_IMAGE_FORMAT = 'png'
+
+# Save settings per output format, tuned for fast writes; frames are
+# re-encoded into a video later, so file size matters less than speed
+IMAGE_FORMATS = {
+    'png': ('PNG', {'compress_level': 1}),
+    'webp': ('WEBP', {'lossless': True, 'method': 0}),
+}
+
+# Precompiled patterns
+_COORD_RE = re.compile(r'Tl X:\s*(\d+).*?Tl Y:\s*(\d+).*?Px X:\s*(\d+).*?Px Y:\s*(\d+)')
+_SEASON_RE = re.compile(r'^(.*/s)([0-9]+)(/tiles.*)$')
 
 # Configure logging
 logging.basicConfig(
@@ -34,6 +59,46 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Shared HTTP session so tile requests reuse keep-alive connections
+SESSION = requests.Session()
+SESSION.headers.update({
+    'Referer': 'https://wplace.live/',
+    'Origin': 'https://wplace.live',
+    'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
+    'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
+    'Accept-Language': 'en-US,en;q=0.9'
+})
+_http_pool_size = 0
+
+
+def ensure_http_pool_size(pool_size: int) -> None:
+    """Remount the session adapter if its connection pool is smaller than pool_size."""
+    global _http_pool_size
+    if pool_size <= _http_pool_size:
+        return
+    SESSION.mount('https://', HTTPAdapter(
+        pool_connections=pool_size,
+        pool_maxsize=pool_size,
+        max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504])
+    ))
+    _http_pool_size = pool_size
+
+
+ensure_http_pool_size(DEFAULT_MAX_WORKERS)
+
+
+# Season URLs and tile path orders ('xy'/'yx') that have served tiles during this run
+_working_season_urls = set()
+_working_tile_orders = set()
+
+# The swapped y/x tile order is only probed during the first screenshot;
+# later screenshots use it only if it actually served a tile
+_probe_swapped_order = True
+
+# Recently fetched tiles by URL as (bytes, validator headers), least recent first
+_tile_memory_cache = OrderedDict()
+_tile_memory_lock = threading.Lock()
+
 
 def detect_tile_server_from_wplace_url(wplace_url: str) -> str:
     """
@@ -92,8 +157,8 @@ def detect_tile_server_from_wplace_url(wplace_url: str) -> str:
 
 
 def build_season_bases(base_url: str) -> List[str]:
-    """Build fallback URLs for different seasons."""
-    match = re.match(r'^(.*/s)([0-9]+)(/tiles.*)$', base_url)
+    """Build fallback URLs for the current season and its neighbors."""
+    match = _SEASON_RE.match(base_url)
     if not match:
         return [base_url]
     
@@ -101,12 +166,14 @@ def build_season_bases(base_url: str) -> List[str]:
     current_s = int(current_season)
     
     season_urls = [base_url]
-    priority_seasons = [0, 1, 2, 3, 4, 5, 6, 7, 8, 9]
     
-    for s in priority_seasons:
-        if s != current_s:
+    for s in (current_s - 1, current_s + 1):
+        if s >= 0:
             season_urls.append(f"{prefix}{s}{suffix}")
     
+    # Try seasons that already served tiles during this run first
+    season_urls.sort(key=lambda url: url not in _working_season_urls)
+    
     return season_urls
 
 
@@ -115,31 +182,157 @@ def compute_absolute_pixel(tx: int, ty: int, px: int, py: int) -> Tuple[int, int
     return (tx * TILE_SIZE_PX + px, ty * TILE_SIZE_PX + py)
 
 
-def fetch_tile_with_fallback(base_urls: List[str], tile_x: int, tile_y: int, timeout: int = 30) -> Optional[bytes]:
-    """Fetch a tile with season fallback."""
-    headers = {
-        'Referer': 'https://wplace.live/',
-        'Origin': 'https://wplace.live',
-        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0.0.0 Safari/537.36',
-        'Accept': 'image/avif,image/webp,image/apng,image/*,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9'
-    }
+def validator_headers(etag: str, last_modified: str) -> Dict[str, str]:
+    """Build conditional request headers from a tile's ETag and Last-Modified."""
+    headers = {}
+    if etag:
+        headers['If-None-Match'] = etag
+    if last_modified:
+        headers['If-Modified-Since'] = last_modified
+    return headers
+
+
+def remember_tile(url: str, data: bytes, headers: Dict[str, str]) -> None:
+    """Keep a tile and its validators in memory, evicting the least recently used."""
+    with _tile_memory_lock:
+        _tile_memory_cache[url] = (data, headers)
+        _tile_memory_cache.move_to_end(url)
+        while len(_tile_memory_cache) > TILE_MEMORY_CACHE_SIZE:
+            _tile_memory_cache.popitem(last=False)
+
+
+class TileCache:
+    """On-disk tile cache used to revalidate tiles with conditional requests."""
     
-    for base_url in base_urls:
-        # Try normal x/y format first
-        url = f"{base_url.rstrip('/')}/{tile_x}/{tile_y}.png"
+    def __init__(self, root: str, max_bytes: int = TILE_CACHE_MAX_BYTES):
+        self.root = Path(root)
+        self.max_bytes = max_bytes
+    
+    def _paths(self, base_url: str, tile_x: int, tile_y: int) -> Tuple[Path, Path]:
+        """Return the tile and sidecar validator paths for a tile URL."""
+        match = _SEASON_RE.match(base_url)
+        season_dir = f"s{match.group(2)}" if match else "default"
+        tile_path = self.root / season_dir / f"{tile_x}_{tile_y}.png"
+        return tile_path, tile_path.with_suffix('.etag')
+    
+    def get(self, base_url: str, tile_x: int, tile_y: int) -> Optional[Tuple[bytes, Dict[str, str]]]:
+        """Return cached tile bytes and the headers needed to revalidate them."""
+        tile_path, etag_path = self._paths(base_url, tile_x, tile_y)
+        try:
+            data = tile_path.read_bytes()
+            etag, last_modified = (etag_path.read_text().split('\n') + ['', ''])[:2]
+            # Mark as recently used for eviction
+            os.utime(tile_path)
+        except (OSError, ValueError):
+            # Missing, unreadable or corrupt entries count as a miss
+            return None
+        
+        headers = validator_headers(etag, last_modified)
+        if not headers:
+            return None
+        return data, headers
+    
+    def put(self, base_url: str, tile_x: int, tile_y: int, data: bytes, response_headers) -> None:
+        """Store tile bytes along with the validators from the response."""
+        etag = response_headers.get('ETag', '')
+        last_modified = response_headers.get('Last-Modified', '')
+        if not etag and not last_modified:
+            return
+        
+        tile_path, etag_path = self._paths(base_url, tile_x, tile_y)
+        try:
+            tile_path.parent.mkdir(parents=True, exist_ok=True)
+            # Write through a temp file so a concurrent reader never sees a partial tile
+            fd, tmp_path = tempfile.mkstemp(dir=tile_path.parent, suffix='.tmp')
+            try:
+                with os.fdopen(fd, 'wb') as f:
+                    f.write(data)
+                os.replace(tmp_path, tile_path)
+            except OSError:
+                os.unlink(tmp_path)
+                raise
+            etag_path.write_text(f"{etag}\n{last_modified}")
+        except OSError as e:
+            logger.warning(f"Could not cache tile {tile_x},{tile_y}: {e}")
+    
+    def evict(self) -> None:
+        """Remove least recently used tiles until the cache fits its byte budget."""
+        entries = []
+        total = 0
+        for tile_path in self.root.glob('*/*.png'):
+            try:
+                stat = tile_path.stat()
+            except OSError:
+                continue
+            size = stat.st_size + 256  # approximate sidecar size
+            entries.append((stat.st_atime, size, tile_path))
+            total += size
+        
+        if total <= self.max_bytes:
+            return
+        
+        entries.sort(key=lambda entry: entry[0])
+        for _, size, tile_path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                tile_path.unlink()
+                tile_path.with_suffix('.etag').unlink(missing_ok=True)
+            except OSError:
+                continue
+            total -= size
         
+        logger.info(f"Tile cache trimmed to {total // 1024} KB")
+
+
+def request_tile(base_url: str, tile_x: int, tile_y: int, timeout: int,
+                 cache: Optional[TileCache] = None) -> Tuple[int, bytes]:
+    """Request a single tile, revalidating against the cache when possible."""
+    url = f"{base_url.rstrip('/')}/{tile_x}/{tile_y}.png"
+    
+    # Tiles fetched earlier in this process are revalidated without touching disk
+    with _tile_memory_lock:
+        cached = _tile_memory_cache.get(url)
+    if cached is None and cache:
+        cached = cache.get(base_url, tile_x, tile_y)
+    
+    response = SESSION.get(url, headers=cached[1] if cached else None, timeout=timeout)
+    
+    if response.status_code == 304 and cached:
+        remember_tile(url, *cached)
+        return 200, cached[0]
+    if response.status_code == 200:
+        headers = validator_headers(response.headers.get('ETag', ''), response.headers.get('Last-Modified', ''))
+        if headers:
+            remember_tile(url, response.content, headers)
+        if cache:
+            cache.put(base_url, tile_x, tile_y, response.content, response.headers)
+    return response.status_code, response.content
+
+
+def fetch_tile_with_fallback(base_urls: List[str], tile_x: int, tile_y: int, timeout: int = 30,
+                             cache: Optional[TileCache] = None) -> Optional[bytes]:
+    """Fetch a tile with season fallback."""
+    for base_url in base_urls:
         try:
-            response = requests.get(url, headers=headers, timeout=timeout)
+            # Try normal x/y format first
+            status, content = request_tile(base_url, tile_x, tile_y, timeout, cache)
             
-            if response.status_code == 200:
-                return response.content
-            elif response.status_code == 404:
-                # Try swapped y/x format
-                url_swapped = f"{base_url.rstrip('/')}/{tile_y}/{tile_x}.png"
-                response = requests.get(url_swapped, headers=headers, timeout=timeout)
-                if response.status_code == 200:
-                    return response.content
+            if status == 200:
+                _working_season_urls.add(base_url)
+                _working_tile_orders.add('xy')
+                return content
+            elif status == 404:
+                # Only try swapped y/x format if the server has served a swapped
+                # tile, or while still probing before x/y is known to work
+                if 'yx' not in _working_tile_orders and (
+                        'xy' in _working_tile_orders or not _probe_swapped_order):
+                    continue
+                status, content = request_tile(base_url, tile_y, tile_x, timeout, cache)
+                if status == 200:
+                    _working_season_urls.add(base_url)
+                    _working_tile_orders.add('yx')
+                    return content
                 continue
             else:
                 continue
@@ -150,10 +343,23 @@ def fetch_tile_with_fallback(base_urls: List[str], tile_x: int, tile_y: int, tim
     return None
 
 
+def decode_tile(tile_data: bytes, shared_tiles: Dict[bytes, Image.Image]) -> Image.Image:
+    """Decode tile bytes, reusing small tiles already decoded in this screenshot."""
+    tile_img = shared_tiles.get(tile_data)
+    if tile_img is None:
+        tile_img = Image.open(BytesIO(tile_data))
+        tile_img.load()
+        if len(tile_data) <= SHARED_TILE_MAX_BYTES:
+            shared_tiles[tile_data] = tile_img
+    return tile_img
+
+
 def take_screenshot(start_tx: int, start_ty: int, start_px: int, start_py: int,
                    end_tx: int, end_ty: int, end_px: int, end_py: int,
-                   base_url: str, output_dir: str) -> Optional[str]:
-    """Take a screenshot of the specified region."""
+                   base_url: str, output_dir: str,
+                   max_workers: int = DEFAULT_MAX_WORKERS,
+                   image_format: str = DEFAULT_IMAGE_FORMAT) -> Optional[str]:
+    """Take a screenshot of the specified region, fetching tiles in parallel."""
     logger.info(f"Taking screenshot from ({start_tx},{start_ty},{start_px},{start_py}) to ({end_tx},{end_ty},{end_px},{end_py})")
     
     # Convert to absolute coordinates
@@ -180,19 +386,42 @@ def take_screenshot(start_tx: int, start_ty: int, start_px: int, start_py: int,
     # Build season URLs for fallback
     season_urls = build_season_bases(base_url)
     
-    # Create canvas
-    canvas = Image.new('RGBA', (total_width, total_height), (0, 0, 0, 0))
+    # Tiles from previous runs are kept next to the screenshots
+    cache = TileCache(os.path.join(output_dir, TILE_CACHE_DIR))
+    
+    # Create canvas (transparent wherever a tile is missing)
+    canvas = np.zeros((total_height, total_width, 4), dtype=np.uint8)
     
     # Fetch and composite tiles
     tiles_fetched = 0
     tiles_total = (tile_end_x - tile_start_x + 1) * (tile_end_y - tile_start_y + 1)
     
-    for ty in range(tile_start_y, tile_end_y + 1):
-        for tx in range(tile_start_x, tile_end_x + 1):
-            tile_data = fetch_tile_with_fallback(season_urls, tx, ty)
+    coords = [(tx, ty)
+              for ty in range(tile_start_y, tile_end_y + 1)
+              for tx in range(tile_start_x, tile_end_x + 1)]
+    
+    # Never start more downloads than there are tiles, and keep one pooled
+    # connection per download so none are opened only to be discarded
+    workers = max(1, min(max_workers, len(coords)))
+    ensure_http_pool_size(workers)
+    
+    # Decoded blank/uniform tiles, reused for repeats within this screenshot only
+    shared_tiles = {}
+    
+    # Downloads run on worker threads; decoding and pasting stay on this
+    # thread since the canvas is shared
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(fetch_tile_with_fallback, season_urls, tx, ty, cache=cache): (tx, ty)
+            for tx, ty in coords
+        }
+        
+        for future in as_completed(futures):
+            tx, ty = futures[future]
+            tile_data = future.result()
             if tile_data:
                 try:
-                    tile_img = Image.open(BytesIO(tile_data))
+                    tile_img = decode_tile(tile_data, shared_tiles)
                     
                     # Calculate position on canvas
                     tile_abs_x = tx * TILE_SIZE_PX
@@ -200,8 +429,18 @@ def take_screenshot(start_tx: int, start_ty: int, start_px: int, start_py: int,
                     left = tile_abs_x - abs_start_x
                     top = tile_abs_y - abs_start_y
                     
-                    # Paste tile onto canvas
-                    canvas.paste(tile_img, (left, top))
+                    # Intersect the tile with the requested region
+                    x0, y0 = max(left, 0), max(top, 0)
+                    x1 = min(left + tile_img.width, total_width)
+                    y1 = min(top + tile_img.height, total_height)
+                    if x1 > x0 and y1 > y0:
+                        # Crop edge tiles before converting so only visible pixels are touched
+                        box = (x0 - left, y0 - top, x1 - left, y1 - top)
+                        if box != (0, 0, tile_img.width, tile_img.height):
+                            tile_img = tile_img.crop(box)
+                        if tile_img.mode != 'RGBA':
+                            tile_img = tile_img.convert('RGBA')
+                        canvas[y0:y1, x0:x1] = np.asarray(tile_img)
                     tiles_fetched += 1
                     
                 except Exception as e:
@@ -209,6 +448,11 @@ def take_screenshot(start_tx: int, start_ty: int, start_px: int, start_py: int,
     
     logger.info(f"Successfully fetched {tiles_fetched}/{tiles_total} tiles")
     
+    # Stop probing the swapped tile order after the first screenshot
+    global _probe_swapped_order
+    _probe_swapped_order = False
+    cache.evict()
+    
     if tiles_fetched == 0:
         logger.error("No tiles were fetched. Check coordinates and connection.")
         return None
@@ -218,12 +462,13 @@ def take_screenshot(start_tx: int, start_ty: int, start_px: int, start_py: int,
     
     # Generate filename with timestamp
     timestamp = datetime.now().strftime("%Y-%m-%d_%H-%M-%S")
-    filename = f"screenshot_{timestamp}.png"
+    filename = f"screenshot_{timestamp}.{image_format}"
     filepath = os.path.join(output_dir, filename)
     
     # Save screenshot
     try:
-        canvas.save(filepath, "PNG")
+        pil_format, save_options = IMAGE_FORMATS[image_format]
+        Image.fromarray(canvas).save(filepath, pil_format, **save_options)
         logger.info(f"Screenshot saved: {filepath}")
         return filepath
     except Exception as e:
@@ -238,8 +483,7 @@ def parse_coordinates(coord_string: str) -> Tuple[int, int, int, int]:
         cleaned = coord_string.strip().strip('()')
         
         # Extract numbers using regex - more flexible pattern
-        pattern = r'Tl X:\s*(\d+).*?Tl Y:\s*(\d+).*?Px X:\s*(\d+).*?Px Y:\s*(\d+)'
-        match = re.search(pattern, cleaned)
+        match = _COORD_RE.search(cleaned)
         
         if match:
             tx, ty, px, py = map(int, match.groups())
@@ -289,6 +533,30 @@ def get_user_inputs():
     if not output_dir:
         output_dir = "project1"
     
+    # Get number of parallel downloads
+    while True:
+        workers_input = input(f"Enter number of parallel tile downloads (default: {DEFAULT_MAX_WORKERS}): ").strip()
+        if not workers_input:
+            max_workers = DEFAULT_MAX_WORKERS
+            break
+        try:
+            max_workers = int(workers_input)
+            if max_workers > 0:
+                break
+            else:
+                print("Number of downloads must be greater than 0")
+        except ValueError:
+            print("Please enter a valid number")
+    
+    # Get image format
+    while True:
+        image_format = input(f"Enter image format (png/webp, default: {DEFAULT_IMAGE_FORMAT}): ").strip().lower()
+        if not image_format:
+            image_format = DEFAULT_IMAGE_FORMAT
+        if image_format in IMAGE_FORMATS:
+            break
+        print("Please enter png or webp")
+    
     # Get interval
     while True:
         interval_input = input("Enter screenshot interval in seconds (e.g., 3600 for 1 hour): ").strip()
@@ -301,10 +569,11 @@ def get_user_inputs():
         except ValueError:
             print("Please enter a valid number")
     
-    return url, (start_tx, start_ty, start_px, start_py), (end_tx, end_ty, end_px, end_py), output_dir, interval
+    return url, (start_tx, start_ty, start_px, start_py), (end_tx, end_ty, end_px, end_py), output_dir, interval, max_workers, image_format
 
 
-def run_screenshot_job(start_coords, end_coords, base_url, output_dir):
+def run_screenshot_job(start_coords, end_coords, base_url, output_dir, max_workers=DEFAULT_MAX_WORKERS,
+                       image_format=DEFAULT_IMAGE_FORMAT):
     """Run screenshot job."""
     try:
         start_tx, start_ty, start_px, start_py = start_coords
@@ -313,7 +582,7 @@ def run_screenshot_job(start_coords, end_coords, base_url, output_dir):
         result = take_screenshot(
             start_tx, start_ty, start_px, start_py,
             end_tx, end_ty, end_px, end_py,
-            base_url, output_dir
+            base_url, output_dir, max_workers, image_format
         )
         if result:
             logger.info(f"Screenshot job completed: {result}")
@@ -326,7 +595,7 @@ def run_screenshot_job(start_coords, end_coords, base_url, output_dir):
 def main():
     try:
         # Get inputs from user
-        url, start_coords, end_coords, output_dir, interval = get_user_inputs()
+        url, start_coords, end_coords, output_dir, interval, max_workers, image_format = get_user_inputs()
         
         # Detect tile server
         base_url = detect_tile_server_from_wplace_url(url)
@@ -338,21 +607,30 @@ def main():
         print(f"End: Tl X: {end_coords[0]}, Tl Y: {end_coords[1]}, Px X: {end_coords[2]}, Px Y: {end_coords[3]}")
         print(f"Output: {output_dir}")
         print(f"Interval: {interval} seconds")
+        print(f"Parallel downloads: {max_workers}")
+        print(f"Image format: {image_format}")
         print(f"Tile server: {base_url}")
         print()
         
         # Take initial screenshot
         logger.info("Taking initial screenshot...")
-        run_screenshot_job(start_coords, end_coords, base_url, output_dir)
+        next_run = time.monotonic() + interval
+        run_screenshot_job(start_coords, end_coords, base_url, output_dir, max_workers, image_format)
         
         # Schedule recurring screenshots
         logger.info(f"Scheduling screenshots every {interval} seconds. Press Ctrl+C to stop.")
-        schedule.every(interval).seconds.do(run_screenshot_job, start_coords, end_coords, base_url, output_dir)
         
-        # Keep running
+        # Sleep until each deadline instead of polling; deadlines advance from
+        # the previous one so job duration doesn't make the schedule drift
         while True:
-            schedule.run_pending()
-            time.sleep(1)
+            time.sleep(max(0.0, next_run - time.monotonic()))
+            run_screenshot_job(start_coords, end_coords, base_url, output_dir, max_workers, image_format)
+            
+            next_run += interval
+            now = time.monotonic()
+            if next_run <= now:
+                # Skip slots missed while a slow job was running
+                next_run += ((now - next_run) // interval + 1) * interval
             
     except KeyboardInterrupt:
         logger.info("Stopping screenshot service...")
@@ -3,11 +3,251 @@
 import cv2
 import os
 import argparse
+import hashlib
+import shutil
+import subprocess
 import numpy as np
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from numba import njit
+except ImportError:  # numba is optional; compositing falls back to OpenCV
+    njit = None
+
+# Worker threads that decode and composite upcoming frames while the current
+# one is encoded. OpenCV releases the GIL, so these run on separate cores
+FRAME_WORKERS = min(8, os.cpu_count() or 1)
+
+# Approximate memory allowed for frames being prepared ahead of the encoder.
+# Each in-flight frame holds its BGRA decode plus the BGR result
+PREFETCH_MEMORY_BYTES = 512 * 1024 * 1024
+
+# Hardware H.264 encoders tried in order before falling back to libx264
+HARDWARE_H264_ENCODERS = ['h264_nvenc', 'h264_videotoolbox', 'h264_qsv']
+
+def _composite_over_white_opencv(img, alpha):
+    # With a white destination the blend reduces to 255 - alpha * (255 - img),
+    # which OpenCV computes with saturating uint8 SIMD kernels (alpha stays
+    # 0..255 throughout)
+    alpha3 = cv2.cvtColor(alpha, cv2.COLOR_GRAY2BGR)
+    shade = cv2.multiply(cv2.bitwise_not(img), alpha3, scale=1 / 255)
+    return cv2.bitwise_not(shade)
+
+if njit is not None:
+    # Same composite fused into a single pass over the pixels, about 3x faster
+    # than the four OpenCV passes. nogil lets the frame worker threads run it
+    # concurrently, so no parallel=True is needed
+    @njit(cache=True, nogil=True)
+    def _composite_over_white_numba(img, alpha):
+        height, width = alpha.shape
+        out = np.empty((height, width, 3), dtype=np.uint8)
+        for y in range(height):
+            for x in range(width):
+                a = np.int32(alpha[y, x])
+                for c in range(3):
+                    # Rounded integer division by 255, matching cv2.multiply
+                    out[y, x, c] = 255 - (a * (255 - np.int32(img[y, x, c])) + 127) // 255
+        return out
+
+    composite_over_white = _composite_over_white_numba
+else:
+    composite_over_white = _composite_over_white_opencv
+
+def prepare_frame(img_path, width, height):
+    # Decode an image, scale it to fit a width x height frame and composite it
+    # over white. Returns the BGR image, or None if it could not be read
+    img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)  # keep alpha if exists
+    if img is None:
+        return None
+
+    # Scale image to fit inside the frame while keeping aspect ratio
+    img_h, img_w = img.shape[:2]
+    scale = min(width / img_w, height / img_h)
+    new_w, new_h = int(img_w * scale), int(img_h * scale)
+
+    # Separate alpha channel if present. Fully opaque images need no blending
+    # and fully transparent ones show only the white background
+    alpha = None
+    if img.shape[2] == 4:
+        alpha_min, alpha_max, _, _ = cv2.minMaxLoc(img[:, :, 3])
+        if alpha_max == 0:
+            return np.full((new_h, new_w, 3), 255, dtype=np.uint8)
+        if alpha_min < 255:
+            alpha = img[:, :, 3]
+        img = img[:, :, :3]
+
+    # Images the same size as the frame (the usual case) need no resize
+    if (new_w, new_h) != (img_w, img_h):
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        img = cv2.resize(img, (new_w, new_h), interpolation=interpolation)
+        if alpha is not None:
+            alpha = cv2.resize(alpha, (new_w, new_h), interpolation=interpolation)
+
+    if alpha is None:
+        return img
+
+    # Composite over the opaque white background
+    return composite_over_white(img, alpha)
+
+def file_key(img_path):
+    # Length and hash of the file contents; equal keys mean byte-identical images
+    try:
+        with open(img_path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return None
+    return len(data), hashlib.blake2b(data, digest_size=16).digest()
+
+def prefetch(executor, func, items, depth):
+    # Yield func(item) for each item in order, keeping up to `depth` calls
+    # running ahead on the executor so memory stays bounded
+    pending = deque()
+    for item in items:
+        pending.append(executor.submit(func, item))
+        if len(pending) > depth:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def h264_encoder_args(encoder):
+    # Explicit constant-quality settings so sharp pixel edges survive no matter
+    # which encoder is picked, instead of each encoder's default bitrate
+    if encoder == 'h264_nvenc':
+        return ['-preset', 'p4', '-rc', 'vbr', '-cq', '19', '-b:v', '0']
+    if encoder == 'h264_videotoolbox':
+        return ['-q:v', '65']
+    if encoder == 'h264_qsv':
+        return ['-global_quality', '20']
+    return ['-preset', 'veryfast', '-crf', '18']
+
+def ffmpeg_command(ffmpeg, encoder, width, height, fps, output_args):
+    return [
+        ffmpeg, '-y', '-hide_banner', '-loglevel', 'error',
+        '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', f'{width}x{height}', '-r', str(fps), '-i', '-',
+        '-c:v', encoder, *h264_encoder_args(encoder),
+        # yuv420p needs even dimensions, so pad odd sizes with white
+        '-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2:color=white', '-pix_fmt', 'yuv420p',
+        *output_args,
+    ]
+
+def find_h264_encoder(ffmpeg, width, height, fps):
+    # Encode one white frame at the real size with the real options, so size
+    # limits of hardware encoders and unsupported options are caught up front.
+    # Returns None if no H.264 encoder works
+    test_frame = b'\xff' * (width * height * 3)
+    for encoder in HARDWARE_H264_ENCODERS + ['libx264']:
+        command = ffmpeg_command(ffmpeg, encoder, width, height, fps, ['-f', 'null', '-'])
+        try:
+            result = subprocess.run(command, input=test_frame, timeout=120,
+                                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        except (OSError, subprocess.TimeoutExpired):
+            continue
+        if result.returncode == 0:
+            return encoder
+    return None
+
+class FFmpegWriter:
+    # Drop-in for cv2.VideoWriter that pipes raw BGR frames to an ffmpeg H.264 encoder
+    def __init__(self, ffmpeg, encoder, output_file, fps, frame_size):
+        width, height = frame_size
+        command = ffmpeg_command(ffmpeg, encoder, width, height, fps, [output_file])
+        self.process = subprocess.Popen(command, stdin=subprocess.PIPE)
+        self.failed = False
+        print(f"Encoding with ffmpeg ({encoder})")
+
+    def write(self, frame):
+        if self.failed:
+            return
+        try:
+            self.process.stdin.write(frame.tobytes())
+        except OSError:  # includes BrokenPipeError when ffmpeg has exited
+            self.failed = True
+
+    def release(self):
+        # Returns False if ffmpeg failed, so the caller can encode another way
+        try:
+            self.process.stdin.close()
+        except OSError:
+            self.failed = True
+        if self.process.wait() != 0:
+            print(f"ffmpeg exited with code {self.process.returncode}")
+            self.failed = True
+        return not self.failed
+
+def opencv_video_writer(output_file, fps, width, height):
+    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
+    return cv2.VideoWriter(output_file, fourcc, fps, (width, height))
+
+def open_video_writer(output_file, fps, width, height):
+    # Prefer H.264 through ffmpeg when it is installed and an encoder handles
+    # this frame size, otherwise use OpenCV's mp4v writer
+    ffmpeg = shutil.which('ffmpeg')
+    encoder = find_h264_encoder(ffmpeg, width, height, fps) if ffmpeg else None
+    if encoder:
+        try:
+            return FFmpegWriter(ffmpeg, encoder, output_file, fps, (width, height))
+        except OSError as e:
+            print(f"Could not start ffmpeg ({e})")
+    return opencv_video_writer(output_file, fps, width, height)
+
+def write_frames(video, input_dir, images, width, height):
+    # Add images to video, preparing upcoming frames on worker threads
+    img_paths = [os.path.join(input_dir, img_name) for img_name in images]
+    with ThreadPoolExecutor(max_workers=FRAME_WORKERS) as executor:
+        # Snapshots often don't change between captures; an image identical to
+        # the one before it reuses the previous frame instead of being decoded
+        keys = list(executor.map(file_key, img_paths))
+        repeats = [i > 0 and keys[i] is not None and keys[i] == keys[i - 1]
+                   for i in range(len(keys))]
+        unique_paths = [path for path, repeat in zip(img_paths, repeats) if not repeat]
+        # Prepare fewer frames ahead when they are large, so memory stays bounded
+        frame_bytes = width * height * (4 + 3)
+        depth = max(1, min(FRAME_WORKERS, PREFETCH_MEMORY_BYTES // frame_bytes - 1))
+        prepared = prefetch(executor, lambda path: prepare_frame(path, width, height),
+                            unique_paths, depth)
+
+        # One frame buffer is reused for every image; only the image area is
+        # rewritten, so the white border is drawn once per image size
+        canvas = np.full((height, width, 3), 255, dtype=np.uint8)
+        layout_size = None
+        have_frame = False
+        for img_name, repeat in zip(images, repeats):
+            # Stop early once the ffmpeg writer has failed; the caller re-encodes
+            if getattr(video, 'failed', False):
+                return
+
+            if repeat:
+                if have_frame:
+                    video.write(canvas)
+                else:
+                    print(f"Skipping {img_name} (could not read)")
+                continue
+
+            frame_img = next(prepared)
+            have_frame = frame_img is not None
+            if frame_img is None:
+                print(f"Skipping {img_name} (could not read)")
+                continue
+
+            new_h, new_w = frame_img.shape[:2]
+            if (new_h, new_w) != layout_size:
+                # Center position
+                x_offset = (width - new_w) // 2
+                y_offset = (height - new_h) // 2
+
+                # Region of interest on canvas
+                if layout_size is not None:
+                    canvas.fill(255)
+                roi = canvas[y_offset:y_offset + new_h, x_offset:x_offset + new_w]
+                layout_size = (new_h, new_w)
+
+            roi[:] = frame_img
+            video.write(canvas)
 
 def images_to_video(input_dir, output_file, fps):
     # Get all image files
-    images = [f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg'))]
+    images = [f for f in os.listdir(input_dir) if f.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))]
     images.sort()  # Sort ascending by filename
 
     if not images:
@@ -21,52 +261,13 @@ def images_to_video(input_dir, output_file, fps):
         frame = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
     height, width, layers = frame.shape
 
-    # Define video writer
-    fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-    video = cv2.VideoWriter(output_file, fourcc, fps, (width, height))
-
-    # Add images to video
-    for img_name in images:
-        img_path = os.path.join(input_dir, img_name)
-        img = cv2.imread(img_path, cv2.IMREAD_UNCHANGED)  # keep alpha if exists
-        if img is None:
-            print(f"Skipping {img_name} (could not read)")
-            continue
-
-        # Separate alpha channel if present
-        if img.shape[2] == 4:
-            alpha = img[:, :, 3] / 255.0
-            img = img[:, :, :3]
-        else:
-            alpha = np.ones(img.shape[:2], dtype=np.float32)
-
-        # Create white background
-        canvas = np.ones((height, width, 3), dtype=np.uint8) * 255
-
-        # Scale image to fit inside the frame while keeping aspect ratio
-        img_h, img_w = img.shape[:2]
-        scale = min(width / img_w, height / img_h)
-        new_w, new_h = int(img_w * scale), int(img_h * scale)
-        resized_img = cv2.resize(img, (new_w, new_h))
-        resized_alpha = cv2.resize(alpha, (new_w, new_h))
-
-        # Center position
-        x_offset = (width - new_w) // 2
-        y_offset = (height - new_h) // 2
-
-        # Region of interest on canvas
-        roi = canvas[y_offset:y_offset + new_h, x_offset:x_offset + new_w]
-
-        # Blend using alpha channel
-        for c in range(3):
-            roi[:, :, c] = (resized_alpha * resized_img[:, :, c] +
-                            (1 - resized_alpha) * roi[:, :, c])
-
-        canvas[y_offset:y_offset + new_h, x_offset:x_offset + new_w] = roi
-
-        video.write(canvas.astype(np.uint8))
-
-    video.release()
+    video = open_video_writer(output_file, fps, width, height)
+    write_frames(video, input_dir, images, width, height)
+    if video.release() is False:
+        print("ffmpeg encoding failed, encoding again with OpenCV")
+        video = opencv_video_writer(output_file, fps, width, height)
+        write_frames(video, input_dir, images, width, height)
+        video.release()
     print(f"Video saved as {output_file}")
 
 if __name__ == "__main__":